@@ -10,8 +10,18 @@
 """
 from __future__ import absolute_import
 
+import datetime
+import decimal
+import errno
+import gzip
+import json
 import math
 import os
+import Queue
+import shutil
+import thread
+import threading
+import time
 
 from bsddb3.db import *
 from dbxml import *
@@ -21,6 +31,91 @@ from flask import _request_ctx_stack, abort, current_app, render_template_string
 from werkzeug.utils import cached_property
 
 
+class QueryLimitError(Exception):
+    """Base class for the errors raised when a query hits one of the
+    configured limits. The query transaction has already been aborted
+    when this is raised (unless the caller owns it, ie. `commit=False`).
+    """
+
+    def __init__(self, limit=None):
+        Exception.__init__(self, limit)
+        self.limit = limit
+
+
+class QueryTimeout(QueryLimitError):
+    """The query ran for longer than the allowed number of seconds."""
+
+
+class QueryInterrupted(QueryLimitError):
+    """The query was cancelled through :meth:`DBXML.interrupt_query`."""
+
+
+class TooManyResults(QueryLimitError):
+    """The query produced more results than allowed."""
+
+
+class ResultTooLarge(QueryLimitError):
+    """The serialized results exceeded the allowed number of bytes."""
+
+
+class BackupNotSupported(RuntimeError):
+    """The storage backend in use can't be backed up."""
+
+
+def _string_value(val):
+    if isinstance(val, unicode):
+        return XmlValue(val.encode('utf-8'))
+    return XmlValue(str(val))
+
+
+def _typed_value(type_id):
+    return lambda val: XmlValue(type_id, str(val))
+
+
+def _decimal_value(val):
+    # str() may use exponent notation, which isn't valid xs:decimal
+    if val.is_finite():
+        return XmlValue(XmlValue.DECIMAL, '{0:f}'.format(val))
+    return XmlValue(float(val))
+
+
+def _isoformat_value(type_id):
+    return lambda val: XmlValue(type_id, val.isoformat())
+
+
+#: Maps Python types to the functions converting their values to XmlValues,
+#: so numbers, booleans and dates are bound with their XML Schema types.
+XMLVALUE_CONVERTERS = {
+    str: XmlValue,
+    unicode: lambda val: XmlValue(val.encode('utf-8')),
+    bool: lambda val: XmlValue(XmlValue.BOOLEAN, val and 'true' or 'false'),
+    int: _typed_value(XmlValue.DECIMAL),
+    long: _typed_value(XmlValue.DECIMAL),
+    decimal.Decimal: _decimal_value,
+    float: XmlValue,
+    datetime.datetime: _isoformat_value(XmlValue.DATE_TIME),
+    datetime.date: _isoformat_value(XmlValue.DATE),
+    datetime.time: _isoformat_value(XmlValue.TIME),
+}
+
+
+def to_xml_value(val):
+    """Converts `val` to an XmlValue of the matching type. Values of unknown
+    types are bound as strings, and non-finite decimals as ``xs:double``."""
+    convert = XMLVALUE_CONVERTERS.get(type(val))
+
+    if convert is None:
+        # Subclasses of the known types; datetime must go before date
+        for cls in (bool, datetime.datetime, datetime.date):
+            if isinstance(val, cls):
+                convert = XMLVALUE_CONVERTERS[cls]
+                break
+        else:
+            convert = _string_value
+
+    return convert(val)
+
+
 def xmlresult(fn):
     """Requires the result passed to be an instance of XmlResults."""
     def wrapper(obj, *args, **kwargs):
@@ -29,6 +124,103 @@ def xmlresult(fn):
     return wrapper
 
 
+class PeriodicThread(threading.Thread):
+    """Daemon thread which calls `fn` every `interval` seconds until
+    :meth:`stop` is called. Failures are reported to `logger` and do not
+    stop the thread."""
+
+    def __init__(self, interval, fn, logger):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.interval = interval
+        self.fn = fn
+        self.logger = logger
+        self.stopped = threading.Event()
+
+    def run(self):
+        while True:
+            self.stopped.wait(self.interval)
+            if self.stopped.isSet():
+                break
+            try:
+                self.fn()
+            except Exception:
+                self.logger.exception('%s failed', self.fn.__name__)
+
+    def stop(self):
+        self.stopped.set()
+        self.join()
+
+
+class DiskBackend(object):
+    """Keeps the environment, the container and the sequences database on
+    disk, under ``DBXML_ENV``. The environment is recovered on open."""
+
+    env_flags = DB_CREATE|DB_INIT_LOCK|DB_INIT_LOG|DB_INIT_MPOOL| \
+                DB_INIT_TXN|DB_THREAD
+
+    #: Whether the files can be copied by :meth:`DBXML.backup`
+    supports_backup = True
+    #: Whether to run the background checkpoint thread
+    needs_checkpoints = True
+
+    def __init__(self, app):
+        self.home = app.config.get('DBXML_ENV')
+        self.database = app.config['DBXML_DATABASE']
+
+        # Archiving needs the logs around until they are moved
+        self.log_autoremove = app.config.get('DBXML_LOG_AUTOREMOVE', True) \
+                              and not app.config.get('DBXML_LOG_ARCHIVE_DIR')
+
+    def open_env(self, env):
+        if self.log_autoremove:
+            env.log_set_config(DB_LOG_AUTO_REMOVE, 1)
+
+        env.open(self.home, self.env_flags|DB_RECOVER_FATAL, 0)
+
+    def open_sequences(self, db):
+        db.open(os.path.join(self.home, 'seq.db'), DB_BTREE,
+                DB_AUTO_COMMIT|DB_CREATE|DB_THREAD)
+
+    def open_container(self, manager, cc):
+        return manager.openContainer(self.database, cc)
+
+
+class MemoryBackend(DiskBackend):
+    """Keeps everything in memory: a private environment with in-memory
+    logs, an in-memory container and an in-memory sequences database.
+    Nothing touches the disk and nothing survives the process, which
+    makes it suitable for tests and benchmarks.
+
+    The container is aliased as ``DBXML_DATABASE`` so the collection
+    URIs used by the queries keep resolving to it.
+    """
+
+    log_buffer_size = 16 * 1024 * 1024
+
+    supports_backup = False
+    needs_checkpoints = False
+
+    def open_env(self, env):
+        env.log_set_config(DB_LOG_IN_MEMORY, 1)
+        env.set_lg_bsize(self.log_buffer_size)
+        env.open(None, self.env_flags|DB_PRIVATE, 0)
+
+    def open_sequences(self, db):
+        db.open(None, None, DB_BTREE, DB_AUTO_COMMIT|DB_CREATE|DB_THREAD)
+
+    def open_container(self, manager, cc):
+        container = manager.openContainer('', cc)
+        container.addAlias(self.database)
+        return container
+
+
+BACKENDS = {
+    'disk': DiskBackend,
+    'memory': MemoryBackend,
+}
+
+
 class Result(object):
 
     def __init__(self, xmlresults):
@@ -102,8 +294,27 @@ class DBXML(object):
     def __init__(self):
         self.manager = None
         self.container = None
+        self._running = {}
+        self._running_lock = threading.Lock()
+        self._threads = []
+        self._log_files_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._bound_sequences = {}
+        self._bound_sequences_lock = threading.Lock()
+        self.stats = {
+            'checkpoints': 0,
+            'checkpoint_time': 0.0,
+            'last_checkpoint_time': 0.0,
+            'archived_logs': 0,
+            'deadlocks_aborted': 0,
+        }
 
     def connect(self, app):
+        backend = app.config.get('DBXML_BACKEND', 'disk')
+        if isinstance(backend, basestring):
+            backend = BACKENDS[backend]
+        self.backend = backend(app)
+
         self.env = DBEnv()
 
         self.env.set_cachesize(app.config['DBXML_CACHESIZE_GB'],
@@ -112,12 +323,9 @@ class DBXML(object):
         self.env.set_lk_max_lockers(app.config['DBXML_MAX_LOCKERS'])
         self.env.set_lk_max_objects(app.config['DBXML_MAX_OBJECTS'])
 
-        if app.config.get('DBXML_LOG_AUTOREMOVE', True):
-            self.env.log_set_config(DB_LOG_AUTO_REMOVE, 1)
+        self.log_archive_dir = app.config.get('DBXML_LOG_ARCHIVE_DIR')
 
-        self.env.open(app.config['DBXML_ENV'],
-                      DB_CREATE|DB_INIT_LOCK|DB_INIT_LOG| \
-                      DB_INIT_MPOOL|DB_INIT_TXN|DB_THREAD|DB_RECOVER_FATAL, 0)
+        self.backend.open_env(self.env)
 
         self.manager = XmlManager(self.env, DBXML_ALLOW_EXTERNAL_ACCESS)
 
@@ -125,8 +333,7 @@ class DBXML(object):
             self.manager.setLogLevel(LEVEL_ALL, True)
 
         self.db = DB(self.env)
-        self.db.open(os.path.join(app.config['DBXML_ENV'], 'seq.db'), DB_BTREE,
-                     DB_AUTO_COMMIT|DB_CREATE|DB_THREAD)
+        self.backend.open_sequences(self.db)
         try:
             cc = XmlContainerConfig()
             cc.setAllowCreate(True)
@@ -134,8 +341,7 @@ class DBXML(object):
             cc.setThreaded(True)
             cc.setTransactional(True)
 
-            self.container = self.manager. \
-                openContainer(app.config['DBXML_DATABASE'], cc)
+            self.container = self.backend.open_container(self.manager, cc)
 
             uc = self.manager.createUpdateContext()
             self.container.setAutoIndexing(False, uc)
@@ -143,7 +349,100 @@ class DBXML(object):
             self.cleanup()
             raise
 
+        self.checkpoint_kbytes = app.config.get('DBXML_CHECKPOINT_KBYTES', 0)
+        self.checkpoint_minutes = app.config.get('DBXML_CHECKPOINT_MINUTES', 0)
+
+        interval = app.config.get('DBXML_CHECKPOINT_INTERVAL', 0)
+        if interval and self.backend.needs_checkpoints:
+            self._threads.append(PeriodicThread(interval, self.checkpoint,
+                                                app.logger))
+
+        interval = app.config.get('DBXML_DEADLOCK_INTERVAL', 0)
+        if interval:
+            self._threads.append(PeriodicThread(interval,
+                                                self.detect_deadlocks,
+                                                app.logger))
+
+        for t in self._threads:
+            t.start()
+
+    def checkpoint(self, force=False):
+        """Checkpoints the environment if more than ``DBXML_CHECKPOINT_KBYTES``
+        of log have been written or ``DBXML_CHECKPOINT_MINUTES`` have passed
+        since the last checkpoint (always, if `force` is set).
+
+        When ``DBXML_LOG_ARCHIVE_DIR`` is set, the log files no longer needed
+        for recovery are moved there afterwards.
+        """
+        last_ckp = self.env.txn_stat()['last_ckp']
+        start = time.time()
+
+        if force:
+            self.env.txn_checkpoint(0, 0, DB_FORCE)
+        else:
+            self.env.txn_checkpoint(self.checkpoint_kbytes,
+                                    self.checkpoint_minutes, 0)
+
+        duration = time.time() - start
+
+        # Below the thresholds no checkpoint is actually taken
+        if self.env.txn_stat()['last_ckp'] != last_ckp:
+            with self._stats_lock:
+                self.stats['checkpoints'] += 1
+                self.stats['checkpoint_time'] += duration
+                self.stats['last_checkpoint_time'] = duration
+
+        if self.log_archive_dir:
+            self.archive_logs()
+
+    def archive_logs(self):
+        """Moves the log files not involved in active transactions to
+        ``DBXML_LOG_ARCHIVE_DIR``."""
+        if not os.path.isdir(self.log_archive_dir):
+            os.makedirs(self.log_archive_dir)
+
+        with self._log_files_lock:
+            for filename in self.env.log_archive(DB_ARCH_ABS) or []:
+                shutil.move(filename, os.path.join(
+                    self.log_archive_dir, os.path.basename(filename)))
+                with self._stats_lock:
+                    self.stats['archived_logs'] += 1
+
+    def detect_deadlocks(self):
+        """Runs the deadlock detector, aborting one of the lockers of every
+        deadlock found."""
+        aborted = self.env.lock_detect(DB_LOCK_DEFAULT)
+
+        with self._stats_lock:
+            self.stats['deadlocks_aborted'] += aborted
+
+    def maintenance_stats(self):
+        """Returns the checkpoint and log metrics as a dictionary.
+
+        Along with the counters in :attr:`stats`, it includes the log
+        volume written in total (``log_bytes``) and since the last
+        checkpoint (``log_bytes_since_checkpoint``).
+        """
+        log_stat = self.env.log_stat()
+
+        with self._stats_lock:
+            stats = dict(self.stats)
+        stats['log_bytes'] = log_stat['w_mbytes'] * 1024 * 1024 + \
+                             log_stat['w_bytes']
+        stats['log_bytes_since_checkpoint'] = \
+            log_stat['wc_mbytes'] * 1024 * 1024 + log_stat['wc_bytes']
+
+        return stats
+
     def cleanup(self):
+        for t in self._threads:
+            t.stop()
+        self._threads = []
+
+        # The cached values belong to the manager being closed
+        with self._bound_sequences_lock:
+            self._bound_sequences.clear()
+
         if hasattr(self, 'container'):
             del self.container
         if hasattr(self, 'manager'):
@@ -154,8 +453,24 @@ class DBXML(object):
 
     def init_app(self, app):
         app.config.setdefault('DBXML_DATABASE', 'default.dbxml')
+        # Either a name from BACKENDS or a DiskBackend-like class
+        app.config.setdefault('DBXML_BACKEND', 'disk')
         app.config.setdefault('DBXML_CACHESIZE_GB', 0)
         app.config.setdefault('DBXML_CACHESIZE_BYTES', 64 * 1024 * 1024)
+        # Query limits, 0 means unlimited
+        app.config.setdefault('DBXML_QUERY_TIMEOUT', 0)
+        app.config.setdefault('DBXML_MAX_RESULTS', 0)
+        app.config.setdefault('DBXML_MAX_RESULT_BYTES', 0)
+        # Bind context values with their XML types instead of as strings
+        app.config.setdefault('DBXML_TYPED_CONTEXT', True)
+        # Number of tuple/frozenset context values kept bound across queries
+        app.config.setdefault('DBXML_BIND_CACHE_SIZE', 128)
+        # Background maintenance, intervals in seconds (0 disables it)
+        app.config.setdefault('DBXML_CHECKPOINT_INTERVAL', 60)
+        app.config.setdefault('DBXML_CHECKPOINT_KBYTES', 1024)
+        app.config.setdefault('DBXML_CHECKPOINT_MINUTES', 5)
+        app.config.setdefault('DBXML_DEADLOCK_INTERVAL', 0)
+        app.config.setdefault('DBXML_LOG_ARCHIVE_DIR', None)
 
         self.connect(app)
 
@@ -246,20 +561,262 @@ class DBXML(object):
             txn.abort()
             print 'Failed to add new indexes.'
 
+    def backup(self, target):
+        """Takes a hot backup of the environment into the `target`
+        directory, while the application keeps running.
+
+        Following the Berkeley DB hot backup procedure, the environment is
+        checkpointed, the database files (the container and ``seq.db``)
+        are copied and then the log files are copied. Opening the backup
+        with catastrophic recovery (as :meth:`connect` does) brings it to
+        a consistent state.
+
+        Raises :class:`BackupNotSupported` if the backend keeps nothing on
+        disk, as :class:`MemoryBackend` does.
+        """
+        if not self.backend.supports_backup:
+            raise BackupNotSupported('%s keeps nothing on disk to back up'
+                                     % type(self.backend).__name__)
+
+        if not os.path.isdir(target):
+            os.makedirs(target)
+
+        # Neither archiving nor Berkeley DB itself may remove log files
+        # while they are being copied
+        with self._log_files_lock:
+            if self.backend.log_autoremove:
+                self.env.log_set_config(DB_LOG_AUTO_REMOVE, 0)
+
+            try:
+                self.env.txn_checkpoint(0, 0, DB_FORCE)
+
+                data_files = set(
+                    self.env.log_archive(DB_ARCH_ABS|DB_ARCH_DATA) or [])
+                home = self.backend.home
+                data_files.add(os.path.abspath(
+                    os.path.join(home, self.backend.database)))
+                data_files.add(os.path.abspath(os.path.join(home, 'seq.db')))
+
+                # Database files must be copied before the log files
+                for filename in sorted(data_files):
+                    if os.path.exists(filename):
+                        shutil.copyfile(filename, os.path.join(
+                            target, os.path.basename(filename)))
+
+                for filename in self.env.log_archive(DB_ARCH_ABS|DB_ARCH_LOG) \
+                                or []:
+                    try:
+                        shutil.copyfile(filename, os.path.join(
+                            target, os.path.basename(filename)))
+                    except IOError, e:
+                        # Removed after being listed: not needed anymore
+                        if e.errno != errno.ENOENT:
+                            raise
+            finally:
+                if self.backend.log_autoremove:
+                    self.env.log_set_config(DB_LOG_AUTO_REMOVE, 1)
+
+    def _document_names(self):
+        """Yields the names of all the documents in the container."""
+        txn = self.manager.createTransaction(DB_READ_COMMITTED)
+
+        try:
+            results = self.container.getAllDocuments(txn, DBXML_LAZY_DOCS)
+            while results.hasNext():
+                yield results.next().asDocument().getName()
+            del results
+            txn.commit()
+        except:
+            txn.abort()
+            raise
+
+    def export_documents(self, filename, workers=4, queue_size=256):
+        """Streams every document in the container to `filename` as gzipped
+        NDJSON, one ``{"name": ..., "content": ...}`` object per line.
+
+        Documents are fetched by `workers` threads; at most `queue_size`
+        document names are queued at any time, so memory usage stays
+        bounded regardless of the container size. Returns the number of
+        exported documents.
+        """
+        names = Queue.Queue(queue_size)
+        write_lock = threading.Lock()
+        errors = []
+        count = [0]
+
+        out = gzip.open(filename, 'wb')
+
+        def worker():
+            # Keeps draining the queue after a failure, so the producer
+            # never waits on a queue nobody consumes
+            while True:
+                name = names.get()
+                if name is None:
+                    break
+                if errors:
+                    continue
+
+                txn = self.manager.createTransaction(DB_READ_COMMITTED)
+                try:
+                    content = self.container.getDocument(txn, name) \
+                                            .getContent()
+                    txn.commit()
+                except Exception, e:
+                    txn.abort()
+                    errors.append(e)
+                    continue
+
+                try:
+                    line = json.dumps({'name': name.decode('utf-8'),
+                                       'content': content.decode('utf-8')})
+                    with write_lock:
+                        out.write(line + '\n')
+                        count[0] += 1
+                except Exception, e:
+                    errors.append(e)
+
+        def put(item):
+            """Queues `item`, giving up if all the workers are gone."""
+            while True:
+                try:
+                    names.put(item, timeout=1)
+                    return True
+                except Queue.Full:
+                    if not any(t.is_alive() for t in threads):
+                        return False
+
+        threads = [threading.Thread(target=worker) for i in xrange(workers)]
+        for t in threads:
+            t.start()
+
+        try:
+            for name in self._document_names():
+                if errors or not put(name):
+                    break
+        finally:
+            for t in threads:
+                put(None)
+            for t in threads:
+                t.join()
+            out.close()
+
+        if errors:
+            raise errors[0]
+
+        return count[0]
+
+    def import_documents(self, filename, batch_size=500):
+        """Loads the documents from a file written by
+        :meth:`export_documents`.
+
+        Documents are stored in batches of `batch_size` per transaction,
+        committed without synchronous log flushing; the environment is
+        checkpointed once the import finishes. Documents already in the
+        container are skipped. Returns the number of imported documents.
+        """
+        update_context = self.manager.createUpdateContext()
+        count = 0
+        pending = 0
+
+        txn = self.manager.createTransaction(DB_TXN_NOSYNC)
+
+        try:
+            with gzip.open(filename, 'rb') as fp:
+                for line in fp:
+                    if not line.strip():
+                        continue
+
+                    doc = json.loads(line)
+
+                    # A child transaction keeps a failed put out of the batch
+                    child = txn.createChild()
+                    try:
+                        self.container.putDocument(
+                            child, doc['name'].encode('utf-8'),
+                            doc['content'].encode('utf-8'), update_context)
+                        child.commit()
+                    except XmlUniqueError:
+                        child.abort()
+                        continue
+
+                    count += 1
+                    pending += 1
+                    if pending >= batch_size:
+                        txn.commit()
+                        txn = self.manager.createTransaction(DB_TXN_NOSYNC)
+                        pending = 0
+
+            txn.commit()
+        except:
+            txn.abort()
+            raise
+
+        self.checkpoint(force=True)
+
+        return count
+
     def generate_id(self, key):
         seq = DBSequence(self.db)
         seq.open(key, txn=None, flags=DB_CREATE|DB_THREAD)
         return seq.get(flags=DB_AUTO_COMMIT|DB_TXN_NOSYNC)
 
-    def _populate_context(self, qc, ctx):
+    def _create_sequence(self, xml_values):
+        """Builds a new XmlResults sequence holding `xml_values`."""
+        results = self.manager.createResults()
+        add = results.add
+        for value in xml_values:
+            add(value)
+        return results
 
-        def _encoded_xml_value(val):
-            if isinstance(val, unicode):
-                newval = val.encode('utf-8')
-            else:
-                newval = str(val)
+    def _bind_sequence(self, values, convert):
+        """Builds the XmlResults sequence holding `values`."""
+        return self._create_sequence(map(convert, values))
+
+    def _bind_immutable_sequence(self, values, convert):
+        """Like :meth:`_bind_sequence`, but reuses the values already
+        converted for equal tuples and frozensets.
+
+        Only the converted XmlValues are cached; every query gets its own
+        XmlResults, as those can't be shared between threads.
+        """
+        # Equal values of different types, like 1 and True, bind differently
+        if isinstance(values, frozenset):
+            key = (convert, frozenset((type(val), val) for val in values))
+        else:
+            key = (convert, tuple(map(type, values)), values)
+
+        try:
+            with self._bound_sequences_lock:
+                xml_values = self._bound_sequences.get(key)
+        except TypeError:
+            # Unhashable items can't be cached
+            return self._bind_sequence(values, convert)
+
+        if xml_values is None:
+            xml_values = tuple(map(convert, values))
+
+            max_size = current_app.config.get('DBXML_BIND_CACHE_SIZE', 0)
+            if max_size:
+                with self._bound_sequences_lock:
+                    if len(self._bound_sequences) >= max_size:
+                        self._bound_sequences.clear()
+                    self._bound_sequences[key] = xml_values
 
-            return XmlValue(newval)
+        return self._create_sequence(xml_values)
+
+    def _populate_context(self, qc, ctx):
+        """Binds the values in `ctx` as variables of the query context `qc`.
+
+        With ``DBXML_TYPED_CONTEXT`` (the default) values are bound with
+        their XML Schema types, see :data:`XMLVALUE_CONVERTERS`; note ints
+        then bind as ``xs:decimal``, so string functions like
+        ``starts-with`` need an explicit ``string()``. Setting it to
+        `False` binds everything as strings.
+        """
+        if current_app.config.get('DBXML_TYPED_CONTEXT', True):
+            convert = to_xml_value
+        else:
+            convert = _string_value
 
         for key, value in ctx.iteritems():
             if value is None:
@@ -267,12 +824,13 @@ class DBXML(object):
 
             if isinstance(value, dict):
                 self._populate_context(qc, value)
-            elif isinstance(value, list):
-                newval = self.manager.createResults()
-                for val in value:
-                    newval.add(_encoded_xml_value(val))
+                continue
+            elif isinstance(value, (tuple, frozenset)):
+                newval = self._bind_immutable_sequence(value, convert)
+            elif isinstance(value, (list, set)):
+                newval = self._bind_sequence(value, convert)
             else:
-                newval = _encoded_xml_value(value)
+                newval = convert(value)
 
             qc.setVariableValue(key, newval)
 
@@ -296,11 +854,83 @@ class DBXML(object):
 
         return self.raw_query(query, context, **kwargs)
 
-    def raw_query(self, query, context={}, txn=None, commit=True):
+    def interrupt_query(self, ident=None):
+        """Interrupts the queries currently running.
+
+        If `ident` is given, only the query running in the thread with that
+        identifier is interrupted. The interrupted :meth:`raw_query` call
+        raises :class:`QueryInterrupted`.
+        """
+        with self._running_lock:
+            if ident is None:
+                contexts = self._running.values()
+            else:
+                contexts = [self._running.get(ident)]
+
+            for query_context in contexts:
+                if query_context is not None:
+                    query_context.interruptQuery()
+
+    def _collect_results(self, results, max_results, max_bytes):
+        """Copies the lazily evaluated `results` out of the transaction,
+        as ``copyResults()`` does, after checking them against the limits.
+
+        The limits are checked on a first pass over the results, which are
+        then reset and copied. The lazy results are always released before
+        returning or raising, so the transaction can be finished safely.
+        """
+        value = None
+
+        try:
+            if max_results or max_bytes:
+                count = 0
+                size = 0
+
+                while results.hasNext():
+                    value = results.next()
+
+                    count += 1
+                    if max_results and count > max_results:
+                        raise TooManyResults(max_results)
+
+                    if max_bytes:
+                        size += len(value.asString())
+                        if size > max_bytes:
+                            raise ResultTooLarge(max_bytes)
+
+                value = None
+                results.reset()
+
+            return results.copyResults()
+        finally:
+            del value
+            del results
+
+    def raw_query(self, query, context={}, txn=None, commit=True,
+                  timeout=None, max_results=None, max_bytes=None):
+        """Runs `query` and returns its :class:`Result`.
+
+        `timeout` (seconds), `max_results` and `max_bytes` override the
+        ``DBXML_QUERY_TIMEOUT``, ``DBXML_MAX_RESULTS`` and
+        ``DBXML_MAX_RESULT_BYTES`` settings for this call. Exceeding any
+        of them raises a :class:`QueryLimitError` subclass.
+        """
+        config = current_app.config
+
+        if timeout is None:
+            timeout = config.get('DBXML_QUERY_TIMEOUT', 0)
+        if max_results is None:
+            max_results = config.get('DBXML_MAX_RESULTS', 0)
+        if max_bytes is None:
+            max_bytes = config.get('DBXML_MAX_RESULT_BYTES', 0)
+
         query_context = self.manager.createQueryContext()
         query_context.setEvaluationType(query_context.Lazy)
 
-        query_context.setBaseURI(current_app.config['DBXML_BASE_URI'])
+        query_context.setBaseURI(config['DBXML_BASE_URI'])
+
+        if timeout:
+            query_context.setQueryTimeoutSeconds(int(math.ceil(timeout)))
 
         context.update({'collection': self.collection})
         self._populate_context(query_context, context)
@@ -308,17 +938,42 @@ class DBXML(object):
         if txn is None:
             txn = self.manager.createTransaction()
 
-        query_expression = self.manager.prepare(txn, query, query_context)
+        # Syntax and static errors in the query are left to the caller
+        try:
+            query_expression = self.manager.prepare(txn, query, query_context)
+        except XmlException:
+            if commit:
+                txn.abort()
+            raise
+
+        ident = thread.get_ident()
+        with self._running_lock:
+            self._running[ident] = query_context
 
         try:
-            result = query_expression.execute(txn, query_context).copyResults()
+            result = self._collect_results(
+                query_expression.execute(txn, query_context),
+                max_results, max_bytes)
             if commit:
                 txn.commit()
+        except QueryLimitError:
+            if commit:
+                txn.abort()
+            raise
         except XmlException, e:
-            result = self.manager.createResults()
             if commit:
                 txn.abort()
+
+            code = e.getExceptionCode()
+            if code == XmlException.OPERATION_TIMEOUT:
+                raise QueryTimeout(timeout)
+            if code == XmlException.OPERATION_INTERRUPTED:
+                raise QueryInterrupted()
+
+            result = self.manager.createResults()
         finally:
+            with self._running_lock:
+                self._running.pop(ident, None)
             del query_context
             del query_expression
 